@@ -1,10 +1,17 @@
-from .audio_offset_finder import find_offset, ensure_non_zero, cross_correlation, std_mfcc, convert_and_trim
+from .audio_offset_finder import (find_offset, ensure_non_zero, cross_correlation, cross_correlation_naive,
+                                  std_mfcc, convert_and_trim, decode_audio, extract_features,
+                                  search_offset, FeatureCache)
 
 
 __all__ = [
     'find_offset',
     'ensure_non_zero',
     'cross_correlation',
+    'cross_correlation_naive',
     'std_mfcc',
     'convert_and_trim',
+    'decode_audio',
+    'extract_features',
+    'search_offset',
+    'FeatureCache',
 ]
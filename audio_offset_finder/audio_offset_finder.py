@@ -18,53 +18,162 @@
 #
 # Modification Copyright (c) 2021 Tony Wu
 
+import hashlib
 import os
 import tempfile
-import warnings
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from subprocess import Popen, PIPE
-# Updated dependency to scipy.io and python_speech_features
-from scipy.io import wavfile
+# Updated dependency to scipy and python_speech_features
+from scipy.signal import fftconvolve
 from python_speech_features import mfcc
 
 
-def find_offset(file1, file2, fs=8000, trim=60 * 15, correl_nframes=1000):
-    tmp1 = convert_and_trim(file1, fs, trim)
-    tmp2 = convert_and_trim(file2, fs, trim)
-    # Removing warnings because of 18 bits block size
-    # outputted by ffmpeg
-    # https://trac.ffmpeg.org/ticket/1843
-    warnings.simplefilter('ignore', wavfile.WavFileWarning)
-    a1 = wavfile.read(tmp1, mmap=True)[1] / (2.0 ** 15)
-    a2 = wavfile.read(tmp2, mmap=True)[1] / (2.0 ** 15)
-    # We truncate zeroes off the beginning of each signals
-    # (only seems to happen in ffmpeg, not in sox)
-    a1 = ensure_non_zero(a1)
-    a2 = ensure_non_zero(a2)
-    mfcc1 = mfcc(a1, samplerate=fs, numcep=13, nfft=512)
-    mfcc2 = mfcc(a2, samplerate=fs, numcep=13, nfft=512)
-    mfcc1 = std_mfcc(mfcc1)
-    mfcc2 = std_mfcc(mfcc2)
+NUMCEP = 13
+NFFT = 512
+
+
+def find_offset(file1, file2, fs=8000, trim=60 * 15, correl_nframes=1000, cache=None):
+    # The two inputs are independent: decode and extract them side by side
+    # (ffmpeg runs in its own process and numpy releases the GIL)
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        f1 = pool.submit(extract_features, file1, fs, trim, cache)
+        f2 = pool.submit(extract_features, file2, fs, trim, cache)
+        mfcc1, mfcc2 = f1.result(), f2.result()
     # Adapt correlation frames in case of very short audio
     correl_nframes = min(correl_nframes, np.shape(mfcc2)[0])
-    c = cross_correlation(mfcc1, mfcc2, nframes=correl_nframes)
-    max_k_index = np.argmax(c)
-    offset = max_k_index * 0.01
-    score = (c[max_k_index] - np.mean(c)) / np.std(c)  # standard score of peak
-    os.remove(tmp1)
-    os.remove(tmp2)
+    k, score = search_offset(mfcc1, mfcc2, correl_nframes)
+    offset = k * 0.01
     return offset, score
 
 
+def search_offset(mfcc1, mfcc2, nframes):
+    c = cross_correlation(mfcc1, mfcc2, nframes=nframes)
+    k = np.argmax(c)
+    score = (c[k] - np.mean(c)) / np.std(c)  # standard score of peak
+    return interpolate_peak(c, k), score
+
+
+def interpolate_peak(c, k):
+    # Fit a parabola through the peak and its neighbours for a sub-frame lag
+    if k <= 0 or k >= len(c) - 1:
+        return float(k)
+    left, centre, right = c[k - 1], c[k], c[k + 1]
+    denominator = left - 2 * centre + right
+    if denominator >= 0:
+        return float(k)
+    return k + 0.5 * float(left - right) / float(denominator)
+
+
+def extract_features(afile, fs, trim, cache=None):
+    # The cache is only an optimisation: any error reading or writing it
+    # falls back to (or keeps) the freshly computed features
+    key = None
+    if cache:
+        try:
+            key = cache.key(afile, fs, trim)
+        except OSError:
+            pass
+    if key:
+        features = cache.get(key)
+        if features is not None:
+            return features
+    signal = decode_audio(afile, fs, trim)
+    # We truncate zeroes off the beginning of each signals
+    # (only seems to happen in ffmpeg, not in sox)
+    signal = ensure_non_zero(signal)
+    features = std_mfcc(mfcc(signal, samplerate=fs, numcep=NUMCEP, nfft=NFFT).astype(np.float32))
+    if key:
+        try:
+            cache.put(key, features)
+        except OSError:
+            pass
+    return features
+
+
+class FeatureCache:
+    # Standardised MFCCs stored as .npy files named after the input's
+    # content hash and the extraction parameters, loaded memory-mapped.
+    # File mtimes serve as LRU timestamps for size-based eviction.
+
+    def __init__(self, root, max_size=1024 ** 3):
+        self.root = root
+        self.max_size = max_size
+
+    def key(self, afile, fs, trim):
+        digest = hashlib.sha256()
+        with open(afile, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 ** 2), b''):
+                digest.update(chunk)
+        params = '%s-%s-%s-%s-%s' % (digest.hexdigest(), fs, trim, NUMCEP, NFFT)
+        return hashlib.sha1(params.encode('utf8')).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.root, key + '.npy')
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            features = np.load(path, mmap_mode='r')
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        return features
+
+    def put(self, key, features):
+        os.makedirs(self.root, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=self.root, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, features)
+            os.replace(tmp, self.path(key))
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.root):
+            if not name.endswith('.npy'):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.root, name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+        size = sum(e[1] for e in entries)
+        for _, length, name in sorted(entries):
+            if size <= self.max_size:
+                break
+            try:
+                os.remove(os.path.join(self.root, name))
+            except OSError:
+                continue
+            size -= length
+
+
 def ensure_non_zero(signal):
     # We add a little bit of static to avoid
     # 'divide by zero encountered in log'
     # during MFCC computation
-    signal += np.random.random(len(signal)) * 10**-10
+    signal += (np.random.random(len(signal)) * 10**-10).astype(signal.dtype)
     return signal
 
 
 def cross_correlation(mfcc1, mfcc2, nframes):
+    # Same result as cross_correlation_naive, but every lag is computed
+    # at once: correlating each coefficient is a convolution with the
+    # reversed window, done by FFT along the time axis.
+    n1, mdim1 = mfcc1.shape
+    n = n1 - nframes + 1
+    if n <= 0:
+        return np.zeros(max(n, 0))
+    cc = fftconvolve(mfcc1, mfcc2[nframes - 1::-1], mode='valid', axes=0)
+    return np.linalg.norm(cc, axis=1)
+
+
+def cross_correlation_naive(mfcc1, mfcc2, nframes):
     n1, mdim1 = mfcc1.shape
     n2, mdim2 = mfcc2.shape
     n = n1 - nframes + 1
@@ -79,6 +188,21 @@ def std_mfcc(mfcc):
     return (mfcc - np.mean(mfcc, axis=0)) / np.std(mfcc, axis=0)
 
 
+def decode_audio(afile, fs, trim):
+    # Decode straight to raw 16-bit PCM on stdout instead of a WAV file
+    psox = Popen([
+        'ffmpeg', '-loglevel', 'panic', '-i', afile, '-vn',
+        '-ac', '1', '-ar', str(fs), '-ss', '0', '-t', str(trim),
+        '-acodec', 'pcm_s16le', '-f', 's16le', 'pipe:1',
+    ], stdout=PIPE, stderr=PIPE)
+    pcm, _ = psox.communicate()
+    if not psox.returncode == 0:
+        raise Exception('FFMpeg failed')
+    signal = np.frombuffer(pcm, dtype='<i2').astype(np.float32)
+    signal *= 1 / 2.0 ** 15
+    return signal
+
+
 def convert_and_trim(afile, fs, trim):
     tmp = tempfile.NamedTemporaryFile(mode='r+b', prefix='offset_', suffix='.wav')
     tmp_name = tmp.name
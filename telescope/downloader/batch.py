@@ -0,0 +1,113 @@
+# Copyright 2021 Tony Wu +https://github.com/tonywu7/
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import logging
+from pathlib import Path
+from typing import Awaitable, Callable, Iterable, List, Optional, Set
+
+from ..util.types import JSONDict
+from .metrics import RunReport, phase, start_report
+from .stream import TwitchStream, ytdl
+
+log = logging.getLogger('batch')
+
+
+class Unlimited:
+    async def __aenter__(self):
+        pass
+
+    async def __aexit__(self, *exc):
+        pass
+
+
+class Limits:
+    def __init__(self, metadata: Optional[int] = None,
+                 chat: Optional[int] = None,
+                 video: Optional[int] = None):
+        self.metadata = asyncio.Semaphore(metadata) if metadata else Unlimited()
+        self.chat = asyncio.Semaphore(chat) if chat else Unlimited()
+        self.video = asyncio.Semaphore(video) if video else Unlimited()
+
+
+class Archive:
+    def __init__(self, path: Optional[str]):
+        self.path = Path(path) if path else None
+        self.entries: Set[str] = set()
+        if not self.path:
+            return
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                self.entries = {line.strip() for line in f}
+        except FileNotFoundError:
+            pass
+
+    @staticmethod
+    def ids_for_url(url: str) -> Set[str]:
+        for ie in ytdl._ies:
+            if ie.ie_key() == 'Generic' or not ie.suitable(url):
+                continue
+            key = ie.ie_key().lower()
+            video_id = ie._match_id(url)
+            # TwitchVod records its ids with a 'v' prefix that
+            # isn't part of the URL.
+            return {f'{key} {video_id}', f'{key} v{video_id}'}
+        return set()
+
+    def has_url(self, url: str) -> bool:
+        return not self.entries.isdisjoint(self.ids_for_url(url))
+
+    def has_info(self, info: JSONDict) -> bool:
+        return ytdl._make_archive_id(info) in self.entries
+
+    def record(self, info: JSONDict):
+        if not self.path:
+            return
+        ytdl.record_download_archive(info)
+        self.entries.add(ytdl._make_archive_id(info))
+
+
+Job = Callable[[TwitchStream, Limits], Awaitable]
+
+
+async def run_batch(urls: Iterable[str], job: Job, limits: Limits,
+                    reports: Optional[List[RunReport]] = None) -> int:
+    archive = Archive(ytdl.params.get('download_archive'))
+    urls = [*dict.fromkeys(u.strip() for u in urls if u.strip())]
+
+    async def run(url: str) -> bool:
+        if archive.has_url(url):
+            log.info(f'Skipping {url}: already in archive')
+            return True
+        report = start_report(url)
+        if reports is not None:
+            reports.append(report)
+        try:
+            async with limits.metadata:
+                with phase('info'):
+                    video: TwitchStream = await TwitchStream.from_url(url)
+            if archive.has_info(video.info):
+                log.info(f'Skipping {url}: already in archive')
+                return True
+            await job(video, limits)
+            archive.record(video.info)
+            return True
+        except Exception as e:
+            log.error(f'Failed to download {url}', exc_info=e)
+            return False
+
+    results = await asyncio.gather(*[run(u) for u in urls])
+    failed = results.count(False)
+    log.info(f'Finished {len(urls) - failed} of {len(urls)} jobs')
+    return failed
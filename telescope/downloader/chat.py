@@ -0,0 +1,90 @@
+# Copyright 2021 Tony Wu +https://github.com/tonywu7/
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+import shutil
+from pathlib import Path
+from typing import IO, Iterable, Iterator, List
+
+import simplejson as json
+
+from ..util.types import JSONDict
+
+log = logging.getLogger('chat')
+
+
+class ChatWriter:
+    # Each offset range gets its own part file so that comments stay in
+    # timeline order without buffering; parts are joined on close.
+
+    def __init__(self, path: Path, ranges=1):
+        self.path = Path(path)
+        if ranges > 1:
+            self.parts = [self.path.with_name(f'{self.path.name}.{i}') for i in range(ranges)]
+        else:
+            self.parts = [self.path]
+        self.files: List[IO] = [open(p, 'w+') for p in self.parts]
+        self.count = 0
+
+    def write(self, page: List[JSONDict], part=0):
+        f = self.files[part]
+        for comment in page:
+            f.write(json.dumps(comment) + '\n')
+        self.count += len(page)
+
+    def close(self):
+        for f in self.files:
+            f.close()
+        self.files = []
+        if len(self.parts) == 1:
+            return
+        with open(self.path, 'wb+') as f:
+            for p in self.parts:
+                with open(p, 'rb') as part:
+                    shutil.copyfileobj(part, f)
+                p.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def iter_chat_log(path: Path) -> Iterator[JSONDict]:
+    seen = set()
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            comment = json.loads(line)
+            if comment['_id'] in seen:
+                continue
+            seen.add(comment['_id'])
+            yield comment
+
+
+def export_chat(source: Path, output: Path, url: str):
+    export_comments(iter_chat_log(source), output, url)
+
+
+def export_comments(comments: Iterable[JSONDict], output: Path, url: str):
+    log.info(f'Exporting chat replay to {output}')
+    with open(output, 'w+') as f:
+        f.write(f'{{"url": {json.dumps(url)}, "comments": [')
+        for i, comment in enumerate(comments):
+            if i:
+                f.write(', ')
+            f.write(json.dumps(comment))
+        f.write(']}')
@@ -0,0 +1,100 @@
+# Copyright 2021 Tony Wu +https://github.com/tonywu7/
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import logging
+from pathlib import Path
+from typing import IO, List, Optional
+
+import simplejson as json
+
+from ..util.types import JSONDict
+
+log = logging.getLogger('checkpoint')
+
+
+class Checkpoint:
+    # One JSON record per line, appended after the segment's bytes have
+    # been flushed to the part file, so a record never refers to data
+    # that isn't on disk. A torn last line is ignored when reading back.
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.records: List[JSONDict] = []
+        self._file: Optional[IO] = None
+
+    def read(self) -> List[JSONDict]:
+        records = []
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        records.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        break
+        except FileNotFoundError:
+            pass
+        return records
+
+    def resume(self, uris: List[str], part: Path) -> int:
+        records = self.read()
+        part = Path(part)
+        offset = 0
+        verified = []
+        with open(part, 'ab+') as f:
+            f.seek(0)
+            # Keep the longest prefix whose bytes on disk still match the
+            # recorded digests; everything after it is downloaded again.
+            for uri, record in zip(uris, records):
+                if record.get('uri') != uri:
+                    break
+                data = f.read(record['size'])
+                if len(data) < record['size']:
+                    log.warning(f'{part} is shorter than recorded in {self.path}')
+                    break
+                if hashlib.md5(data).hexdigest() != record.get('md5'):
+                    log.warning(f'Segment {len(verified)} in {part} does not match {self.path}')
+                    break
+                offset += record['size']
+                verified.append(record)
+            f.truncate(offset)
+        self.records = verified
+        self.flush()
+
+        if verified:
+            log.info(f'Resuming from segment {len(verified)} of {len(uris)} ({offset} bytes)')
+        return len(verified)
+
+    def flush(self):
+        self.close()
+        with open(self.path, 'w+') as f:
+            for record in self.records:
+                f.write(json.dumps(record) + '\n')
+
+    def record(self, uri: str, data: bytes):
+        if not self._file:
+            self._file = open(self.path, 'a+')
+        record = {'uri': uri, 'size': len(data), 'md5': hashlib.md5(data).hexdigest()}
+        self.records.append(record)
+        self._file.write(json.dumps(record) + '\n')
+        self._file.flush()
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+    def remove(self):
+        self.close()
+        self.path.unlink(missing_ok=True)
@@ -13,38 +13,152 @@
 # limitations under the License.
 
 import asyncio
+import re
 from contextlib import asynccontextmanager
 from pathlib import Path
+from typing import List, Optional, Union
 
 import click
 import simplejson as json
 
+from ..util.ffmpeg import (DEFAULT_FEATURE_CACHE_SIZE, DEFAULT_FEATURE_ROOT,
+                           init_feature_cache)
+from .batch import Limits, run_batch
+from .fetcher import DEFAULT_BUFFER_SIZE, DEFAULT_WINDOW
+from .infocache import DEFAULT_ROOT, DEFAULT_TTL
+from .infocache import init as init_cache
+from .metrics import RunReport, get_report, phase, show_progress, start_report
 from .postprocess import extend_stream
-from .session import close_session, init
+from .segcache import DEFAULT_ROOT as DEFAULT_SEGMENT_ROOT
+from .segcache import init as init_segment_cache
+from .session import DEFAULT_RETRIES, close_session, init
 from .stream import TwitchStream
 
 
+class ByteRate(click.ParamType):
+    name = 'rate'
+    UNITS = {'': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
+
+    def convert(self, value, param, ctx):
+        if isinstance(value, (int, float)):
+            return value
+        match = re.fullmatch(r'([\d.]+)\s*([kmg]?)(?:i?b)?(?:/s)?', value.strip().lower())
+        if not match:
+            self.fail(f'{value} is not a valid rate (e.g. 500k, 8M)', param, ctx)
+        return float(match.group(1)) * self.UNITS[match.group(2)]
+
+
+class ByteSize(ByteRate):
+    name = 'size'
+
+
+class Timestamp(click.ParamType):
+    name = 'timestamp'
+
+    def convert(self, value, param, ctx):
+        if isinstance(value, (int, float)):
+            return value
+        try:
+            seconds = 0
+            for part in value.split(':'):
+                seconds = seconds * 60 + float(part)
+        except ValueError:
+            self.fail(f'{value} is not a valid timestamp (e.g. 1:02:03.5, 3723)', param, ctx)
+        return seconds
+
+
+def stream_options(f):
+    options = [
+        click.option('-n', '--no-download', default=False, is_flag=True),
+        click.option('-p', '--save-m3u8', default=False, is_flag=True),
+        click.option('-c', '--chat', default=False, is_flag=True),
+        click.option('--chat-parallel', default=1, type=click.IntRange(min=1)),
+        click.option('--chat-format', default='json', type=click.Choice(['json', 'jsonl'])),
+        click.option('-t', '--thumbnail', default=False, is_flag=True),
+        click.option('-e', '--extended', default=False, is_flag=True),
+        click.option('-N', '--native', default=False, is_flag=True),
+        click.option('-r', '--resume', default=False, is_flag=True),
+        click.option('-F', '--follow', default=False, is_flag=True),
+        click.option('-j', '--workers', default=1, type=click.IntRange(min=1)),
+        click.option('--fragmented', default=False, is_flag=True),
+        click.option('-S', '--start', default=None, type=Timestamp()),
+        click.option('-E', '--end', default=None, type=Timestamp()),
+        click.option('-w', '--window', default=DEFAULT_WINDOW, type=click.IntRange(min=1)),
+        click.option('--buffer-size', default=DEFAULT_BUFFER_SIZE // 1024 ** 2, type=click.IntRange(min=1)),
+    ]
+    for option in reversed(options):
+        f = option(f)
+    return f
+
+
+def check_stream_options(follow=False, workers=1, start=None, end=None, extended=False, **kwargs):
+    # Following reads the live playlist as it grows, so it cannot honor
+    # a fixed range, a split or the validated extended playlist.
+    if not follow:
+        return
+    conflicts = [name for name, value in (('--workers', workers > 1), ('--start', start is not None),
+                                          ('--end', end is not None), ('--extended', extended))
+                 if value]
+    if conflicts:
+        raise click.UsageError(f'--follow cannot be combined with {", ".join(conflicts)}')
+
+
 @click.group()
-def downloader():
-    pass
+@click.option('--info-cache', default=str(DEFAULT_ROOT), type=click.Path(file_okay=False))
+@click.option('--info-ttl', default=DEFAULT_TTL, type=click.FloatRange(min=0))
+@click.option('--segment-cache', default=str(DEFAULT_SEGMENT_ROOT), type=click.Path(file_okay=False))
+@click.option('--segment-cache-size', default=0, type=ByteSize())
+@click.option('--feature-cache', default=str(DEFAULT_FEATURE_ROOT), type=click.Path(file_okay=False))
+@click.option('--feature-cache-size', default=DEFAULT_FEATURE_CACHE_SIZE, type=ByteSize())
+@click.option('--concurrency', default=32, type=click.IntRange(min=1))
+@click.option('--per-host', default=0, type=click.IntRange(min=0))
+@click.option('--dns-ttl', default=300, type=click.IntRange(min=0))
+@click.option('--timeout', default=60, type=click.FloatRange(min=0))
+@click.option('--retries', default=DEFAULT_RETRIES, type=click.IntRange(min=0))
+@click.option('--max-rate', default=0, type=ByteRate())
+@click.option('--video-rate', default=0, type=ByteRate())
+@click.option('--chat-rate', default=0, type=ByteRate())
+@click.option('--metadata-rate', default=0, type=ByteRate())
+@click.option('--progress', default=False, is_flag=True)
+@click.option('--no-report', default=False, is_flag=True)
+@click.pass_context
+def downloader(ctx, info_cache, info_ttl, segment_cache, segment_cache_size, feature_cache, feature_cache_size,
+               concurrency, per_host, dns_ttl, timeout, retries,
+               max_rate, video_rate, chat_rate, metadata_rate, progress, no_report):
+    init_cache(Path(info_cache), info_ttl)
+    init_segment_cache(Path(segment_cache), int(segment_cache_size))
+    init_feature_cache(Path(feature_cache), int(feature_cache_size))
+    ctx.ensure_object(dict)['REPORT'] = {'progress': progress, 'emit': not no_report}
+    ctx.obj['SESSION'] = {
+        'concurrency': concurrency,
+        'limit_per_host': per_host,
+        'dns_ttl': dns_ttl,
+        'read_timeout': timeout,
+        'retries': retries,
+        'bandwidth': {
+            'total': max_rate,
+            'video': video_rate,
+            'chat': chat_rate,
+            'metadata': metadata_rate,
+        },
+    }
 
 
 @downloader.command()
 @click.argument('url')
 @click.option('-o', '--output', default='.', type=click.Path(exists=True, file_okay=False))
-@click.option('-n', '--no-download', default=False, is_flag=True)
-@click.option('-p', '--save-m3u8', default=False, is_flag=True)
-@click.option('-c', '--chat', default=False, is_flag=True)
-@click.option('-t', '--thumbnail', default=False, is_flag=True)
-@click.option('-e', '--extended', default=False, is_flag=True)
+@stream_options
 def download(url, output, **kwargs):
+    check_stream_options(**kwargs)
     output = Path(output)
 
     async def run_download():
-        async with run_session():
-            video: TwitchStream = await TwitchStream.from_url(url)
+        async with run_session(), run_report(url) as report:
+            with phase('info'):
+                video: TwitchStream = await TwitchStream.from_url(url)
             await common(video, output, **kwargs)
             video.dump(output)
+            emit_report(report, output / video.filename_report)
 
     asyncio.run(run_download())
 
@@ -52,41 +166,109 @@ def download(url, output, **kwargs):
 @downloader.command()
 @click.argument('info')
 @click.option('-o', '--output', default='.', type=click.Path(exists=True, file_okay=False))
-@click.option('-n', '--no-download', default=False, is_flag=True)
-@click.option('-p', '--save-m3u8', default=False, is_flag=True)
-@click.option('-c', '--chat', default=False, is_flag=True)
-@click.option('-t', '--thumbnail', default=False, is_flag=True)
-@click.option('-e', '--extended', default=False, is_flag=True)
+@stream_options
 def load(info, output, **kwargs):
+    check_stream_options(**kwargs)
     output = Path(output)
+    root = Path(info).parent
     with open(info) as f:
         info = json.load(f)
 
     async def run_load_info():
-        async with run_session():
-            video: TwitchStream = TwitchStream(info)
-            await video.load_m3u()
+        async with run_session(), run_report(info.get('webpage_url')) as report:
+            video: TwitchStream = TwitchStream(info, root)
+            with phase('info'):
+                await video.load_m3u()
             await common(video, output, **kwargs)
             video.dump(output)
+            emit_report(report, output / video.filename_report)
+
+    asyncio.run(run_load_info())
+
+
+@downloader.command()
+@click.argument('urls', nargs=-1)
+@click.option('-f', '--file', 'url_file', type=click.File('r'))
+@click.option('-o', '--output', default='.', type=click.Path(exists=True, file_okay=False))
+@click.option('--max-metadata', default=4, type=click.IntRange(min=1))
+@click.option('--max-chat', default=4, type=click.IntRange(min=1))
+@click.option('--max-video', default=2, type=click.IntRange(min=1))
+@stream_options
+def batch(urls, url_file, output, max_metadata, max_chat, max_video, **kwargs):
+    check_stream_options(**kwargs)
+    output = Path(output)
+    urls = [*urls, *(url_file or [])]
+
+    async def job(video: TwitchStream, limits: Limits):
+        await common(video, output, limits=limits, overwrite=False, **kwargs)
+        video.dump(output)
+        emit_report(get_report(), output / video.filename_report)
 
-    asyncio.run(run_load_info(info, output, **kwargs))
+    async def run_batch_download():
+        reports = []
+        async with run_session(), run_progress(reports):
+            limits = Limits(max_metadata, max_chat, max_video)
+            return await run_batch(urls, job, limits, reports)
+
+    if asyncio.run(run_batch_download()):
+        raise SystemExit(1)
+
+
+@downloader.command()
+@click.argument('info')
+@click.option('-o', '--output', default='.', type=click.Path(exists=True, file_okay=False))
+def export_chat(info, output):
+    root = Path(info).parent
+    with open(info) as f:
+        info = json.load(f)
+    TwitchStream(info, root).export_chat(Path(output))
 
 
 @downloader.command()
 @click.argument('url')
 @click.option('-s', '--segments', required=True, type=click.Path(exists=True, file_okay=False))
 @click.option('-o', '--output', required=False, type=click.Path(exists=False, dir_okay=False))
-def complete(url, segments, output=None):
+@click.option('--fragmented', default=False, is_flag=True)
+def complete(url, segments, output=None, fragmented=False):
     async def run_postprocess():
         async with run_session():
-            await extend_stream(url, segments, output)
+            await extend_stream(url, segments, output, fragmented=fragmented)
 
     asyncio.run(run_postprocess())
 
 
+def report_options():
+    options = click.get_current_context().find_object(dict) or {}
+    return options.get('REPORT', {'progress': False, 'emit': True})
+
+
+@asynccontextmanager
+async def run_progress(reports: Union[RunReport, List[RunReport]]):
+    progress = asyncio.ensure_future(show_progress(reports)) if report_options()['progress'] else None
+    try:
+        yield
+    finally:
+        if progress:
+            progress.cancel()
+            await asyncio.gather(progress, return_exceptions=True)
+
+
+@asynccontextmanager
+async def run_report(name):
+    report = start_report(name)
+    async with run_progress(report):
+        yield report
+
+
+def emit_report(report: Optional[RunReport], path: Path):
+    if report and report_options()['emit']:
+        report.dump(path)
+
+
 @asynccontextmanager
 async def run_session():
-    init(concurrency=32)
+    options = click.get_current_context().find_object(dict) or {}
+    init(**options.get('SESSION', {'concurrency': 32}))
     try:
         yield
     finally:
@@ -94,18 +276,34 @@ async def run_session():
 
 
 async def common(video: TwitchStream, wd,
-                 chat=True, thumbnail=True,
+                 chat=True, chat_parallel=1, chat_format='json', thumbnail=True,
                  extended=True, no_download=False,
-                 save_m3u8=False):
+                 save_m3u8=False, native=False, resume=False, follow=False, workers=1, fragmented=False,
+                 start=None, end=None, overwrite=None,
+                 window=DEFAULT_WINDOW, buffer_size=DEFAULT_BUFFER_SIZE // 1024 ** 2,
+                 limits: Limits = None):
+    limits = limits or Limits()
     video.scan_for_muted()
     if chat:
-        await video.load_chat()
+        async with limits.chat:
+            with phase('chat'):
+                await video.load_chat(chat_parallel, wd)
+        if chat_format == 'json':
+            with phase('export_chat'):
+                video.export_chat(wd, remove=True)
     if thumbnail:
-        await video.load_thumbnail(wd)
+        async with limits.metadata:
+            with phase('thumbnail'):
+                await video.load_thumbnail(wd)
     if not no_download:
-        await video.load_stream(extended, wd)
+        async with limits.video:
+            with phase('stream'):
+                await video.load_stream(extended, wd, native=native, resume=resume,
+                                        follow=follow, workers=workers, fragmented=fragmented,
+                                        start=start, end=end, overwrite=overwrite,
+                                        window=window, buffer_size=buffer_size * 1024 ** 2)
     if save_m3u8:
-        video.m3u.dump(video.filename_m3u)
+        video.playlist.dump(video.filename_m3u)
         video.m3u_normalized(extended).dump(video.filename_m3u_norm)
 
 
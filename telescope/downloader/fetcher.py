@@ -0,0 +1,168 @@
+# Copyright 2021 Tony Wu +https://github.com/tonywu7/
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import logging
+import subprocess
+from asyncio.subprocess import create_subprocess_exec as run_async
+from collections import deque
+from pathlib import Path
+from typing import (AsyncIterator, BinaryIO, Deque, Iterable, List, Optional,
+                    Tuple)
+
+import aiohttp
+
+from .checkpoint import Checkpoint
+from .metrics import record_bytes, track_ffmpeg
+from .segcache import get_cache
+from .session import read_body, request
+
+log = logging.getLogger('fetcher')
+
+DEFAULT_WINDOW = 8
+DEFAULT_BUFFER_SIZE = 64 * 1024 ** 2
+
+
+class IncompleteSegment(aiohttp.ClientPayloadError):
+    def __init__(self, uri: str, expected: int, received: int):
+        super().__init__(f'Expected {expected} bytes from {uri}, got {received}')
+        self.uri = uri
+
+
+async def read_segment(res: aiohttp.ClientResponse) -> bytes:
+    res.raise_for_status()
+    data = await read_body(res, 'video')
+    if res.content_length is not None and len(data) != res.content_length:
+        raise IncompleteSegment(str(res.url), res.content_length, len(data))
+    return data
+
+
+async def fetch_segment(uri: str) -> bytes:
+    cache = get_cache()
+    if not cache:
+        return await request(uri, read_segment, label='segment', kind='video')
+    loop = asyncio.get_running_loop()
+    cached = await loop.run_in_executor(None, cache.get, uri)
+    headers = {}
+    if cached:
+        data, etag = cached
+        if not etag:
+            record_bytes('cache', len(data))
+            return data
+        # Revalidate against the ETag the segment was cached with; a 304
+        # costs a round trip but no body.
+        headers['If-None-Match'] = etag
+
+    async def read(res: aiohttp.ClientResponse):
+        if cached and res.status == 304:
+            return None, None
+        return await read_segment(res), res.headers.get('ETag')
+
+    fresh, etag = await request(uri, read, label='segment', kind='video', headers=headers)
+    if fresh is None:
+        record_bytes('cache', len(data))
+        return data
+    await loop.run_in_executor(None, cache.put, uri, fresh, etag)
+    return fresh
+
+
+class SegmentFetcher:
+    def __init__(self, uris: Iterable[str], *,
+                 window: int = DEFAULT_WINDOW,
+                 buffer_size: int = DEFAULT_BUFFER_SIZE):
+        self.uris = iter(enumerate(uris))
+        self.window = max(window, 1)
+        self.buffer_size = buffer_size
+        self.buffered = 0
+        self.pending: Deque[asyncio.Task] = deque()
+
+    async def fetch(self, index: int, uri: str) -> Tuple[int, bytes]:
+        log.debug(f'Downloading segment {index}: {uri}')
+        data = await fetch_segment(uri)
+        self.buffered += len(data)
+        return index, data
+
+    def fill(self):
+        # Completed segments wait here until every segment before them
+        # has been consumed, so stop scheduling once the buffer is full.
+        while len(self.pending) < self.window and self.buffered < self.buffer_size:
+            try:
+                index, uri = next(self.uris)
+            except StopIteration:
+                return
+            self.pending.append(asyncio.ensure_future(self.fetch(index, uri)))
+
+    async def __aiter__(self) -> AsyncIterator[Tuple[int, bytes]]:
+        try:
+            self.fill()
+            while self.pending:
+                index, data = await self.pending.popleft()
+                self.buffered -= len(data)
+                self.fill()
+                yield index, data
+        finally:
+            self.close()
+
+    def close(self):
+        for task in self.pending:
+            task.cancel()
+        self.pending.clear()
+
+
+async def pipe_segments(uris: Iterable[str], output: Path, *ffargs, **kwargs):
+    proc = await run_async('ffmpeg', *['-y', '-progress', 'pipe:1', '-f', 'mpegts', '-i', 'pipe:',
+                                       *ffargs, str(output)],
+                           stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    progress = asyncio.ensure_future(track_ffmpeg(Path(output).name, proc.stdout))
+    fetcher = SegmentFetcher(uris, **kwargs)
+    try:
+        async for _, data in fetcher:
+            try:
+                proc.stdin.write(data)
+                await proc.stdin.drain()
+            except (BrokenPipeError, ConnectionResetError):
+                # ffmpeg stops reading early when given an output limit (-to/-t).
+                log.debug(f'ffmpeg closed its input for {output}')
+                break
+    finally:
+        fetcher.close()
+        proc.stdin.close()
+        await proc.wait()
+        await progress
+
+
+async def append_segments(uris: List[str], f: BinaryIO,
+                          checkpoint: Optional[Checkpoint] = None, **kwargs):
+    loop = asyncio.get_running_loop()
+
+    def write(data: bytes):
+        f.write(data)
+        f.flush()
+
+    async for index, data in SegmentFetcher(uris, **kwargs):
+        await loop.run_in_executor(None, write, data)
+        if checkpoint:
+            checkpoint.record(uris[index], data)
+
+
+async def save_segments(uris: Iterable[str], output: Path,
+                        checkpoint: Optional[Checkpoint] = None, **kwargs):
+    uris = list(uris)
+    skip = checkpoint.resume(uris, output) if checkpoint else 0
+    with open(output, 'ab' if checkpoint else 'wb+') as f:
+        try:
+            await append_segments(uris[skip:], f, checkpoint, **kwargs)
+        finally:
+            if checkpoint:
+                checkpoint.close()
@@ -0,0 +1,67 @@
+# Copyright 2021 Tony Wu +https://github.com/tonywu7/
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import logging
+import time
+from pathlib import Path
+from typing import Optional
+
+import simplejson as json
+
+from ..util.fs import atomic_write, cache_root
+from ..util.types import JSONDict
+
+log = logging.getLogger('infocache')
+
+DEFAULT_ROOT = cache_root('info')
+DEFAULT_TTL = 6 * 3600
+
+
+class InfoCache:
+    def __init__(self, root: Path = DEFAULT_ROOT, ttl: float = DEFAULT_TTL):
+        self.root = Path(root)
+        self.ttl = ttl
+
+    def path_for(self, url: str) -> Path:
+        return self.root / f'{hashlib.sha1(url.encode("utf8")).hexdigest()}.json'
+
+    def get(self, url: str) -> Optional[JSONDict]:
+        path = self.path_for(url)
+        try:
+            if time.time() - path.stat().st_mtime > self.ttl:
+                return None
+            with open(path) as f:
+                info = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return None
+        log.debug(f'Using cached info for {url}')
+        return info
+
+    def put(self, url: str, info: JSONDict):
+        self.root.mkdir(parents=True, exist_ok=True)
+        with atomic_write(self.path_for(url)) as f:
+            json.dump(info, f)
+
+
+cache: Optional[InfoCache] = None
+
+
+def init(root: Path = DEFAULT_ROOT, ttl: float = DEFAULT_TTL):
+    global cache
+    cache = InfoCache(root, ttl) if ttl > 0 else None
+
+
+def get_cache() -> Optional[InfoCache]:
+    return cache
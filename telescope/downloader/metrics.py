@@ -0,0 +1,185 @@
+# Copyright 2021 Tony Wu +https://github.com/tonywu7/
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import bisect
+import logging
+import sys
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from pathlib import Path
+from typing import Dict, List, Optional, Union
+
+import simplejson as json
+
+from ..util.ffmpeg import read_progress
+from ..util.types import JSONDict
+
+log = logging.getLogger('metrics')
+
+
+class Histogram:
+    BOUNDS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.BOUNDS, value)] += 1
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def to_json(self) -> JSONDict:
+        buckets = {f'le_{b}': c for b, c in zip(self.BOUNDS, self.counts)}
+        buckets['inf'] = self.counts[-1]
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else None,
+            'min': self.min,
+            'max': self.max,
+            'buckets': buckets,
+        }
+
+
+class RunReport:
+    def __init__(self, name: Optional[str] = None):
+        self.name = name
+        self.started = time.time()
+        self.phases: Dict[str, float] = {}
+        self.current_phase: Optional[str] = None
+        self.bytes = Counter()
+        self.latency: Dict[str, Histogram] = defaultdict(Histogram)
+        self.ffmpeg: Dict[str, JSONDict] = {}
+
+    @contextmanager
+    def phase(self, name: str):
+        previous = self.current_phase
+        self.current_phase = name
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0) + time.perf_counter() - start
+            self.current_phase = previous
+
+    def update_ffmpeg(self, label: str, progress: Dict[str, str], wall: float):
+        try:
+            out_time = int(progress.get('out_time_us') or progress.get('out_time_ms', 0)) / 1e6
+        except ValueError:
+            out_time = 0
+        self.ffmpeg[label] = {
+            'out_time': out_time,
+            'total_size': int(progress.get('total_size', 0) or 0),
+            'speed': progress.get('speed', '').strip(),
+            'wall': wall,
+            'effective_speed': out_time / wall if wall else None,
+        }
+
+    def progress_line(self) -> str:
+        elapsed = time.time() - self.started
+        total = sum(self.bytes.values())
+        line = (f'[{self.current_phase or "idle"}] {total / 1024 ** 2:.1f} MiB '
+                f'({total / 1024 ** 2 / elapsed if elapsed else 0:.2f} MiB/s)')
+        if self.ffmpeg:
+            out_time = sum(p['out_time'] for p in self.ffmpeg.values())
+            speeds = ' '.join(p['speed'] or '?' for p in self.ffmpeg.values())
+            line += f' ffmpeg {out_time:.0f}s @ {speeds}'
+        return line
+
+    def to_json(self) -> JSONDict:
+        elapsed = time.time() - self.started
+        return {
+            'name': self.name,
+            'started': self.started,
+            'elapsed': elapsed,
+            'phases': self.phases,
+            'bytes': dict(self.bytes),
+            'throughput': sum(self.bytes.values()) / elapsed if elapsed else None,
+            'latency': {k: v.to_json() for k, v in self.latency.items()},
+            'ffmpeg': self.ffmpeg,
+        }
+
+    def dump(self, path: Path):
+        log.info(f'Writing run report to {path}')
+        with open(path, 'w+') as f:
+            json.dump(self.to_json(), f, indent=2)
+
+
+current: ContextVar[Optional[RunReport]] = ContextVar('report', default=None)
+
+
+def start_report(name: Optional[str] = None) -> RunReport:
+    report = RunReport(name)
+    current.set(report)
+    return report
+
+
+def get_report() -> Optional[RunReport]:
+    return current.get()
+
+
+def record_bytes(kind: str, amount: int):
+    report = current.get()
+    if report:
+        report.bytes[kind] += amount
+
+
+def record_latency(label: str, seconds: float):
+    report = current.get()
+    if report:
+        report.latency[label].observe(seconds)
+
+
+@contextmanager
+def phase(name: str):
+    report = current.get()
+    if not report:
+        yield
+        return
+    with report.phase(name):
+        yield
+
+
+async def track_ffmpeg(label: str, stdout: asyncio.StreamReader):
+    report = current.get()
+    start = time.perf_counter()
+    async for progress in read_progress(stdout):
+        if report:
+            report.update_ffmpeg(label, progress, time.perf_counter() - start)
+
+
+async def show_progress(reports: Union[RunReport, List[RunReport]], interval=1.0):
+    # Either a single run, or the list a batch appends its jobs' reports to;
+    # for a batch, only jobs that are in some phase are shown.
+    if isinstance(reports, RunReport):
+        reports = [reports]
+    try:
+        while True:
+            if len(reports) == 1:
+                line = reports[0].progress_line()
+            else:
+                line = ' | '.join(f'{r.name}: {r.progress_line()}' for r in reports if r.current_phase)
+            sys.stderr.write(f'\r{line}\033[K')
+            sys.stderr.flush()
+            await asyncio.sleep(interval)
+    finally:
+        sys.stderr.write('\n')
@@ -0,0 +1,243 @@
+# Copyright 2021 Tony Wu +https://github.com/tonywu7/
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import re
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import urljoin
+
+import m3u8
+import numpy as np
+import simplejson as json
+
+from ..util.types import JSONDict
+
+RE_TRIMMED_SEG = re.compile(r'\d+v\d+-(\d+)\.ts')
+
+FLAG_DISCONTINUITY = 1
+FLAG_MUTED = 2
+FLAG_TRIMMED = 4
+
+M3U_TAGS = {
+    '#EXT-X-TARGETDURATION': ('targetduration', int),
+    '#EXT-X-MEDIA-SEQUENCE': ('media_sequence', int),
+    '#EXT-X-PLAYLIST-TYPE': ('playlist_type', str.lower),
+    '#EXT-X-VERSION': ('version', int),
+}
+
+
+def _rename(uri: str, name: str) -> str:
+    head, sep, tail = uri.rpartition('/')
+    _, q, query = tail.partition('?')
+    return f'{head}{sep}{name}{q}{query}'
+
+
+class Playlist:
+    # Segments are kept as parallel arrays instead of m3u8.Segment objects:
+    # names (as written in the playlist), durations and a bit field of
+    # FLAG_* values, plus byte sizes where known (-1 otherwise). m3u8
+    # objects are only built when asked for.
+
+    def __init__(self, uri: Optional[str], attrs: Dict[str, Any],
+                 names: List[str], durations: np.ndarray, flags: np.ndarray,
+                 content: Optional[str] = None, sizes: Optional[np.ndarray] = None):
+        self.uri = uri
+        self.attrs = attrs
+        self.names = names
+        self.durations = durations
+        self.flags = flags
+        self.content = content
+        self.sizes = sizes if sizes is not None else np.full(len(names), -1, dtype=np.int64)
+
+    @classmethod
+    def loads(cls, content: str, uri: Optional[str] = None) -> 'Playlist':
+        attrs = {'is_endlist': False, 'media_sequence': 0, 'playlist_type': None,
+                 'version': None, 'targetduration': None}
+        names = []
+        durations = []
+        flags = []
+        duration = None
+        flag = 0
+        for line in content.splitlines():
+            line = line.strip()
+            if not line:
+                continue
+            if line[0] != '#':
+                if duration is None:
+                    continue
+                names.append(line)
+                durations.append(duration)
+                if 'muted' in line:
+                    flag |= FLAG_MUTED
+                if RE_TRIMMED_SEG.search(line):
+                    flag |= FLAG_TRIMMED
+                flags.append(flag)
+                duration = None
+                flag = 0
+            elif line.startswith('#EXTINF:'):
+                duration = float(line[8:].split(',', 1)[0])
+            elif line == '#EXT-X-DISCONTINUITY':
+                flag |= FLAG_DISCONTINUITY
+            elif line == '#EXT-X-ENDLIST':
+                attrs['is_endlist'] = True
+            else:
+                tag, _, value = line.partition(':')
+                if tag in M3U_TAGS:
+                    key, parse = M3U_TAGS[tag]
+                    attrs[key] = parse(value)
+        return cls(uri, attrs, names,
+                   np.array(durations, dtype=np.float64),
+                   np.array(flags, dtype=np.uint8),
+                   content)
+
+    @classmethod
+    def from_arrays(cls, arrays) -> 'Playlist':
+        meta = json.loads(str(arrays['playlist']))
+        return cls(meta.pop('uri'), meta, arrays['names'].tolist(),
+                   arrays['durations'], arrays['flags'], sizes=arrays['sizes'])
+
+    def to_arrays(self) -> Dict[str, np.ndarray]:
+        return {
+            'playlist': np.array(json.dumps({'uri': self.uri, **self.attrs})),
+            'names': np.array(self.names, dtype=str),
+            'durations': self.durations,
+            'flags': self.flags,
+            'sizes': self.sizes,
+        }
+
+    def __len__(self):
+        return len(self.names)
+
+    @property
+    def is_endlist(self) -> bool:
+        return self.attrs['is_endlist']
+
+    @property
+    def media_sequence(self) -> int:
+        return self.attrs['media_sequence'] or 0
+
+    @property
+    def targetduration(self) -> Optional[int]:
+        return self.attrs['targetduration']
+
+    @property
+    def uris(self) -> List[str]:
+        if not self.uri:
+            return [*self.names]
+        base = self.uri.rpartition('/')[0] + '/'
+        return [n if '://' in n
+                else base + n if n[0] not in './'
+                else urljoin(self.uri, n)
+                for n in self.names]
+
+    @property
+    def starts(self) -> np.ndarray:
+        return np.concatenate(([0], np.cumsum(self.durations)[:-1]))
+
+    @property
+    def duration(self) -> float:
+        return float(self.durations.sum())
+
+    def has_flag(self, flag: int) -> np.ndarray:
+        return (self.flags & flag).astype(bool)
+
+    def take(self, indices) -> 'Playlist':
+        indices = np.asarray(indices, dtype=np.intp)
+        return Playlist(self.uri, {**self.attrs}, [self.names[i] for i in indices],
+                        self.durations[indices], self.flags[indices], sizes=self.sizes[indices])
+
+    def normalized(self, extended=False) -> 'Playlist':
+        names = self.uris
+        durations = self.durations.copy()
+        flags = self.flags.copy()
+        if extended:
+            trimmed = np.flatnonzero(self.has_flag(FLAG_TRIMMED))
+            for i in trimmed:
+                match = RE_TRIMMED_SEG.search(names[i])
+                names[i] = _rename(names[i], f'{match.group(1)}.ts')
+            durations[trimmed] = self.targetduration
+            flags[trimmed] &= ~np.uint8(FLAG_TRIMMED)
+        return Playlist(None, {**self.attrs}, names, durations, flags, sizes=self.sizes.copy())
+
+    def select(self, start: Optional[float] = None, end: Optional[float] = None) -> Tuple['Playlist', float]:
+        starts = self.starts
+        ends = starts + self.durations
+        first = 0 if start is None else int(np.searchsorted(ends, start, side='right'))
+        last = len(self) if end is None else int(np.searchsorted(starts, end, side='left'))
+        offset = 0 if start is None or first >= len(self) else max(start - starts[first], 0)
+        return self.take(np.arange(first, last)), float(offset)
+
+    def partition(self, n: int) -> List['Playlist']:
+        if n <= 1 or len(self) <= 1:
+            return [self]
+        starts = self.starts
+        total = self.duration
+        cuts = np.searchsorted(starts, total * np.arange(1, n) / n)
+        # Prefer cutting at a nearby discontinuity so that timestamp jumps
+        # fall on part boundaries instead of inside a part.
+        discontinuities = np.flatnonzero(self.has_flag(FLAG_DISCONTINUITY))
+        if discontinuities.size:
+            nearest = np.clip(np.searchsorted(discontinuities, cuts), 1, discontinuities.size) - 1
+            for i, cut in enumerate(cuts):
+                candidates = discontinuities[nearest[i]:nearest[i] + 2]
+                best = candidates[np.argmin(np.abs(starts[candidates] - starts[min(cut, len(self) - 1)]))]
+                if abs(starts[best] - starts[min(cut, len(self) - 1)]) < total / n / 10:
+                    cuts[i] = best
+        cuts = np.unique(np.clip(cuts, 1, len(self) - 1))
+        bounds = [0, *cuts.tolist(), len(self)]
+        return [self.take(np.arange(a, b)) for a, b in zip(bounds[:-1], bounds[1:])]
+
+    def muted_ranges(self) -> List[JSONDict]:
+        muted = self.has_flag(FLAG_MUTED)
+        if not muted.any():
+            return []
+        starts = self.starts
+        total = self.duration
+        edges = np.diff(np.concatenate(([0], muted.astype(np.int8), [0])))
+        ranges = []
+        for first, last in zip(np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)):
+            ranges.append({
+                'start': float(starts[first]),
+                'end': float(starts[last]) if last < len(self) else total,
+                'before': self.names[first - 1] if first > 0 else None,
+                'after': self.names[last] if last < len(self) else None,
+            })
+        return ranges
+
+    def dumps(self) -> str:
+        if self.content is not None:
+            return self.content
+        lines = ['#EXTM3U']
+        if self.attrs['version'] is not None:
+            lines.append(f'#EXT-X-VERSION:{self.attrs["version"]}')
+        if self.targetduration is not None:
+            lines.append(f'#EXT-X-TARGETDURATION:{self.targetduration}')
+        lines.append(f'#EXT-X-MEDIA-SEQUENCE:{self.media_sequence}')
+        if self.attrs['playlist_type']:
+            lines.append(f'#EXT-X-PLAYLIST-TYPE:{self.attrs["playlist_type"].upper()}')
+        for uri, duration, flag in zip(self.uris, self.durations.tolist(), self.flags.tolist()):
+            if flag & FLAG_DISCONTINUITY:
+                lines.append('#EXT-X-DISCONTINUITY')
+            lines.append(f'#EXTINF:{duration:.3f},')
+            lines.append(uri)
+        if self.is_endlist:
+            lines.append('#EXT-X-ENDLIST')
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, path: Path):
+        with open(path, 'w+') as f:
+            f.write(self.dumps())
+
+    def to_m3u8(self) -> m3u8.M3U8:
+        return m3u8.loads(self.dumps(), uri=self.uri)
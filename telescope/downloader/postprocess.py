@@ -20,17 +20,52 @@ from pathlib import Path
 
 from ..util.ffmpeg import (FFmpegException, concat_mts, get_start_time,
                            trim_overlap)
+from ..util.segments import find_discontinuities, index_segments
+from .fetcher import append_segments, fetch_segment
 from .stream import TwitchStream
 
+HEAD_MARGIN = 60
 
-async def extend_stream(url: str, segment_dir: Path, output: Path = None, suffix='.mts'):
-    log = logging.getLogger('postprocess')
+log = logging.getLogger('postprocess')
 
-    segments = [*sorted(p for p in Path(segment_dir).iterdir() if p.suffix == suffix)]
-    first = str(segments[0])
 
-    start = await get_start_time(first)
-    outpoint = start + 60
+async def fetch_head(video: TwitchStream, start: float, output: Path) -> bool:
+    # Map the recording's first PTS onto the VOD timeline using the PTS
+    # of the VOD's own first segment, then fetch only the segments up to
+    # a margin past that point.
+    # Rewritten trimmed URIs may not exist; validate them first.
+    playlist = await video.validate_extended()
+    if not playlist:
+        return False
+    uris = playlist.uris
+    first = await fetch_segment(uris[0])
+    try:
+        base = await get_start_time('pipe:', first)
+    except (FFmpegException, ValueError):
+        return False
+    offset = start - base
+    if not 0 <= offset <= playlist.duration:
+        log.warning(f'Recording starts at {offset:.3f}s into the VOD, which is out of range')
+        return False
+    head, _ = playlist.select(0, offset + HEAD_MARGIN)
+    log.info(f'Recording starts at {offset:.3f}s into the VOD; fetching {len(head)} segments')
+    with open(output, 'wb+') as f:
+        f.write(first)
+        await append_segments(head.uris[1:], f)
+    return True
+
+
+async def extend_stream(url: str, segment_dir: Path, output: Path = None, suffix='.mts',
+                        fragmented=False):
+    index = await index_segments(segment_dir, suffix)
+    if not index:
+        raise ValueError(f'No {suffix} segments found in {segment_dir}')
+    for d in find_discontinuities(index):
+        kind = 'Gap' if d.is_gap else 'Overlap'
+        log.warning(f'{kind} of {abs(d.delta):.3f}s between {d.before.path.name} and {d.after.path.name}')
+    segments = [s.path for s in index]
+    first = str(segments[0])
+    start = index[0].start
 
     video: TwitchStream = await TwitchStream.from_url(url)
 
@@ -43,14 +78,16 @@ async def extend_stream(url: str, segment_dir: Path, output: Path = None, suffix
         tempdir = Path(tempdir)
 
         head = tempdir / 'head.mts'
-        await video.pipe_stream(video.m3u_normalized(), head,
-                                '-to', str(outpoint), '-c', 'copy')
+        if not await fetch_head(video, start, head):
+            log.info('Falling back to remuxing the start of the VOD')
+            await video.pipe_stream(video.m3u_normalized(), head,
+                                    '-to', str(start + HEAD_MARGIN), '-c', 'copy', native=True)
 
         trimmed = tempdir / 'trimmed.mts'
         await trim_overlap(head, first, trimmed)
 
         try:
-            await concat_mts([trimmed, *segments], output or video.filename)
+            await concat_mts([trimmed, *segments], output, fragmented=fragmented)
         except FFmpegException as e:
             log.error('Error concatenating files:')
             log.error(e.stderr)
@@ -0,0 +1,141 @@
+# Copyright 2021 Tony Wu +https://github.com/tonywu7/
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import logging
+import os
+import threading
+from pathlib import Path
+from typing import Optional, Set, Tuple
+
+import simplejson as json
+
+from ..util.fs import atomic_write, cache_root
+
+log = logging.getLogger('segcache')
+
+DEFAULT_ROOT = cache_root('segments')
+DEFAULT_MAX_SIZE = 4 * 1024 ** 3
+
+
+class SegmentCache:
+    # Segment bodies are stored once under their SHA-256 (objects/), and
+    # each URI gets a small ref file (refs/) recording the digest, length
+    # and ETag it was served with. Object mtimes double as LRU timestamps.
+
+    def __init__(self, root: Path = DEFAULT_ROOT, max_size: int = DEFAULT_MAX_SIZE):
+        self.root = Path(root)
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.size: Optional[int] = None
+
+    def ref_path(self, uri: str) -> Path:
+        return self.root / 'refs' / f'{hashlib.sha1(uri.encode("utf8")).hexdigest()}.json'
+
+    def object_path(self, digest: str) -> Path:
+        return self.root / 'objects' / digest[:2] / digest
+
+    def get(self, uri: str) -> Optional[Tuple[bytes, Optional[str]]]:
+        try:
+            with open(self.ref_path(uri)) as f:
+                ref = json.load(f)
+            path = self.object_path(ref['digest'])
+            with open(path, 'rb') as f:
+                data = f.read()
+            if len(data) != ref['length']:
+                return None
+            os.utime(path)
+        except (OSError, KeyError, json.JSONDecodeError):
+            return None
+        return data, ref.get('etag')
+
+    def put(self, uri: str, data: bytes, etag: Optional[str] = None):
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.object_path(digest)
+        if path.exists():
+            os.utime(path)
+            with self.lock:
+                self._usage()
+        else:
+            self._write(path, data)
+            with self.lock:
+                self.size = self._usage() + len(data)
+        ref = {'uri': uri, 'etag': etag, 'length': len(data), 'digest': digest}
+        self._write(self.ref_path(uri), json.dumps(ref).encode('utf8'))
+        if self.size > self.max_size:
+            self.evict()
+
+    def evict(self):
+        with self.lock:
+            objects = []
+            for path in (self.root / 'objects').glob('*/*'):
+                try:
+                    stat = path.stat()
+                except OSError:
+                    continue
+                objects.append((stat.st_mtime, stat.st_size, path))
+            objects.sort()
+            size = sum(o[1] for o in objects)
+            # Evict down to 90% so that every put doesn't trigger a scan.
+            target = self.max_size * .9
+            evicted: Set[str] = set()
+            for _, length, path in objects:
+                if size <= target:
+                    break
+                try:
+                    path.unlink()
+                except OSError:
+                    continue
+                size -= length
+                evicted.add(path.name)
+            self.size = size
+            if evicted:
+                self._prune_refs(evicted)
+        if evicted:
+            log.debug(f'Evicted {len(evicted)} segments from cache')
+
+    def _prune_refs(self, digests: Set[str]):
+        for path in (self.root / 'refs').glob('*.json'):
+            try:
+                with open(path) as f:
+                    digest = json.load(f).get('digest')
+            except (OSError, json.JSONDecodeError):
+                digest = None
+            if digest is None or digest in digests:
+                try:
+                    path.unlink()
+                except OSError:
+                    pass
+
+    def _usage(self) -> int:
+        if self.size is None:
+            self.size = sum(p.stat().st_size for p in (self.root / 'objects').glob('*/*'))
+        return self.size
+
+    def _write(self, path: Path, data: bytes):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with atomic_write(path, 'wb') as f:
+            f.write(data)
+
+
+cache: Optional[SegmentCache] = None
+
+
+def init(root: Path = DEFAULT_ROOT, max_size: int = DEFAULT_MAX_SIZE):
+    global cache
+    cache = SegmentCache(root, max_size) if max_size > 0 else None
+
+
+def get_cache() -> Optional[SegmentCache]:
+    return cache
@@ -13,27 +13,143 @@
 # limitations under the License.
 
 import asyncio
+import hashlib
 import logging
 import mimetypes
+import random
+import time
+from collections import Counter
 from pathlib import Path
+from typing import (AsyncIterator, Awaitable, Callable, Dict, NamedTuple,
+                    Optional, TypeVar)
 
 import aiohttp
+import simplejson as json
+
+from .metrics import record_bytes, record_latency
 
 loop: asyncio.AbstractEventLoop = None
 sem: asyncio.Semaphore = None
+class_sems: Dict[str, asyncio.Semaphore] = {}
 session: aiohttp.ClientSession = None
 log = logging.getLogger('aiohttp.session')
 
+CHUNK_SIZE = 64 * 1024
+DEFAULT_RETRIES = 5
+DEFAULT_BACKOFF = 0.5
+
+IDEMPOTENT_METHODS = frozenset({'GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'})
+RETRY_STATUSES = frozenset({408, 429, 500, 502, 503, 504})
+RETRY_EXCEPTIONS = (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError)
+
+T = TypeVar('T')
+
+
+class Download(NamedTuple):
+    path: Path
+    size: int
+    digest: str
+
+
+class RetryPolicy(NamedTuple):
+    retries: int = DEFAULT_RETRIES
+    backoff: float = DEFAULT_BACKOFF
+    max_backoff: float = 30
+
+    def delay(self, attempt: int) -> float:
+        # Full jitter: sleep anywhere between zero and the exponential cap.
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: Optional[float] = None):
+        self.rate = rate
+        self.capacity = burst or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def consume(self, amount: int):
+        if not self.rate:
+            return
+        # Callers go into debt and sleep it off while holding the lock,
+        # which keeps waiters in FIFO order and lets chunks larger than
+        # the bucket through.
+        async with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= amount
+            if self.tokens < 0:
+                await asyncio.sleep(-self.tokens / self.rate)
+
+
+class Governor:
+    CLASSES = ('video', 'chat', 'metadata')
+
+    def __init__(self, total: float = 0, **rates: float):
+        self.total = TokenBucket(total)
+        self.buckets = {k: TokenBucket(rates.get(k, 0)) for k in self.CLASSES}
+
+    async def throttle(self, kind: str, amount: int):
+        await self.buckets[kind].consume(amount)
+        await self.total.consume(amount)
+
+    def limits(self, kind: str) -> bool:
+        return bool(self.total.rate or self.buckets[kind].rate)
+
+
+policy = RetryPolicy()
+governor = Governor()
+stats = Counter()
+
+
+def _trace_config() -> aiohttp.TraceConfig:
+    def count(key):
+        async def handler(session, ctx, params):
+            stats[key] += 1
+        return handler
+
+    trace = aiohttp.TraceConfig()
+    trace.on_request_start.append(count('requests'))
+    trace.on_connection_create_end.append(count('connections_created'))
+    trace.on_connection_reuseconn.append(count('connections_reused'))
+    trace.on_dns_cache_hit.append(count('dns_cache_hits'))
+    trace.on_dns_cache_miss.append(count('dns_cache_misses'))
+    return trace
 
-def init(*, concurrency=1):
+
+def init(*, concurrency=1, limit_per_host=0, dns_ttl=300, keepalive=30,
+         connect_timeout=30, read_timeout=60, retries=DEFAULT_RETRIES,
+         backoff=DEFAULT_BACKOFF, bandwidth: Optional[Dict[str, float]] = None):
     global loop
     global sem
+    global class_sems
     global session
+    global policy
+    global governor
 
     loop = asyncio.get_running_loop()
     sem = asyncio.Semaphore(concurrency, loop=loop)
+    # Throttled reads sleep while holding a slot; capping each traffic
+    # class below the total keeps some slots free for the others.
+    share = max(concurrency - concurrency // 4, 1)
+    class_sems = {k: asyncio.Semaphore(share, loop=loop) for k in Governor.CLASSES}
+    policy = RetryPolicy(retries, backoff)
+    governor = Governor(**(bandwidth or {}))
+    stats.clear()
+    connector = aiohttp.TCPConnector(
+        loop=loop,
+        limit=concurrency,
+        limit_per_host=limit_per_host,
+        ttl_dns_cache=dns_ttl,
+        keepalive_timeout=keepalive,
+    )
     session = aiohttp.ClientSession(
         loop=loop,
+        connector=connector,
+        timeout=aiohttp.ClientTimeout(total=None, sock_connect=connect_timeout, sock_read=read_timeout),
+        trace_configs=[_trace_config()],
         headers={
             'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10.15; rv:82.0) Gecko/20100101 Firefox/82.0',
         },
@@ -48,21 +164,98 @@ def get_semaphore():
     return sem
 
 
+def get_stats() -> Counter:
+    return stats
+
+
+def is_throttled(kind: str) -> bool:
+    return governor.limits(kind)
+
+
 async def close_session():
     await session.close()
+    if stats:
+        log.info('Session statistics: ' + ', '.join(f'{k}={v}' for k, v in sorted(stats.items())))
+
+
+async def request(url: str, handler: Callable[[aiohttp.ClientResponse], Awaitable[T]],
+                  method='GET', label='request', kind='metadata', **kwargs) -> T:
+    retries = policy.retries if method in IDEMPOTENT_METHODS else 0
+    attempt = 0
+    while True:
+        try:
+            async with class_sems[kind], sem:
+                start = time.perf_counter()
+                async with session.request(method, url, **kwargs) as res:
+                    record_latency(label, time.perf_counter() - start)
+                    if res.status in RETRY_STATUSES:
+                        res.raise_for_status()
+                    return await handler(res)
+        except aiohttp.ClientResponseError as e:
+            if e.status not in RETRY_STATUSES or attempt >= retries:
+                stats['failures'] += 1
+                raise
+            reason = e.status
+        except RETRY_EXCEPTIONS as e:
+            if attempt >= retries:
+                stats['failures'] += 1
+                raise
+            reason = type(e).__name__
+        delay = policy.delay(attempt)
+        attempt += 1
+        stats['retries'] += 1
+        log.debug(f'Retrying {url} in {delay:.2f}s ({reason}, attempt {attempt}/{retries})')
+        await asyncio.sleep(delay)
+
 
+async def iter_body(res: aiohttp.ClientResponse, kind='metadata',
+                    chunk_size=CHUNK_SIZE) -> AsyncIterator[bytes]:
+    async for chunk in res.content.iter_chunked(chunk_size):
+        await governor.throttle(kind, len(chunk))
+        record_bytes(kind, len(chunk))
+        yield chunk
 
-async def fetch(url: str):
-    async with sem, session.get(url) as res:
-        return await res.read(), res
 
+async def read_body(res: aiohttp.ClientResponse, kind='metadata') -> bytes:
+    return b''.join([chunk async for chunk in iter_body(res, kind)])
 
-async def download(url: str, filename: Path):
+
+async def read_text(res: aiohttp.ClientResponse, kind='metadata') -> str:
+    res.raise_for_status()
+    body = await read_body(res, kind)
+    return body.decode(res.get_encoding())
+
+
+async def read_json(res: aiohttp.ClientResponse, kind='metadata'):
+    res.raise_for_status()
+    return json.loads(await read_text(res, kind))
+
+
+async def fetch(url: str, **kwargs):
+    async def read(res: aiohttp.ClientResponse):
+        return await read_body(res), res
+    return await request(url, read, label='fetch', **kwargs)
+
+
+async def download(url: str, filename: Path, chunk_size=CHUNK_SIZE) -> Download:
     log.debug(f'Downloading {filename}')
-    data, res = await fetch(url)
-    suffix = mimetypes.guess_extension(res.content_type)
-    if suffix:
-        filename = filename.with_suffix(suffix)
-    with open(filename, 'wb+') as f:
-        f.write(data)
-    return data, res
+    loop = asyncio.get_running_loop()
+
+    async def write(res: aiohttp.ClientResponse) -> Download:
+        path = filename
+        suffix = mimetypes.guess_extension(res.content_type)
+        if suffix:
+            path = path.with_suffix(suffix)
+        digest = hashlib.sha256()
+        size = 0
+        f = await loop.run_in_executor(None, open, path, 'wb+')
+        try:
+            async for chunk in iter_body(res, 'metadata', chunk_size):
+                digest.update(chunk)
+                size += len(chunk)
+                await loop.run_in_executor(None, f.write, chunk)
+        finally:
+            await loop.run_in_executor(None, f.close)
+        return Download(path, size, digest.hexdigest())
+
+    return await request(url, write, label='download')
@@ -12,20 +12,32 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import asyncio
 import logging
-import re
 import subprocess
+import tempfile
 from asyncio.subprocess import create_subprocess_exec as run_async
+from functools import partial
 from pathlib import Path
-from typing import List, Optional
+from typing import AsyncIterator, Dict, List, Optional
 
+import aiohttp
 import m3u8
+import numpy as np
 import simplejson as json
 import youtube_dl
 
+from ..util.ffmpeg import (FRAGMENTED_MOVFLAGS, FragmentedWriter, concat_mts,
+                           run_ffmpeg)
 from ..util.types import JSONDict
-from ..util.urlkit import url_path_op
-from .session import download, get_semaphore, get_session
+from .chat import ChatWriter, export_chat, export_comments
+from .checkpoint import Checkpoint
+from .fetcher import (SegmentFetcher, append_segments, pipe_segments,
+                      save_segments)
+from .infocache import get_cache
+from .metrics import phase, track_ffmpeg
+from .playlist import FLAG_TRIMMED, Playlist
+from .session import download, is_throttled, read_json, read_text, request
 
 log = logging.getLogger('twitch_dl')
 ytdl = youtube_dl.YoutubeDL({
@@ -37,25 +49,53 @@ ytdl = youtube_dl.YoutubeDL({
     'logger': logging.getLogger('ytdl'),
 })
 
-M3U_ATTRS = ('is_endlist', 'media_sequence', 'playlist_type', 'version', 'targetduration')
-RE_TRIMMED_SEG = re.compile(r'\d+v\d+-(\d+)\.ts')
-
 
 class HLS:
     @classmethod
     async def from_url(cls, url):
-        info = cls.get_info(url)
+        cache = get_cache()
+        info = cache and cache.get(url)
+        if info:
+            return cls(info)
+        info = await cls.get_info(url)
         stream = cls(info)
         await stream.load_m3u()
+        if cache:
+            try:
+                cache.put(url, stream.serialize())
+            except OSError as e:
+                log.warning(f'Cannot write info cache for {url}: {e}')
         return stream
 
-    def __init__(self, info: JSONDict):
+    def __init__(self, info: JSONDict, root: Optional[Path] = None):
         self.info = info
-        m3u = info.get('_m3u')
-        if m3u:
-            self.m3u = m3u8.loads(m3u['content'], m3u['uri'])
-        else:
-            self.m3u = None
+        self.root = Path(root or '.')
+        self._playlist: Optional[Playlist] = None
+        self.m3u_validators: Dict[str, str] = {}
+
+    @property
+    def playlist(self) -> Optional[Playlist]:
+        # Parsed on first access so that opening an info file for its
+        # metadata doesn't pay for the playlist.
+        if self._playlist is None:
+            m3u = self.info.get('_m3u') or {}
+            if m3u.get('content'):
+                self._playlist = Playlist.loads(m3u['content'], m3u['uri'])
+            elif self.info.get('_sidecar'):
+                with self.open_sidecar() as arrays:
+                    if 'names' in arrays.files:
+                        self._playlist = Playlist.from_arrays(arrays)
+        return self._playlist
+
+    @playlist.setter
+    def playlist(self, playlist: Optional[Playlist]):
+        self._playlist = playlist
+
+    @property
+    def m3u(self) -> Optional[m3u8.M3U8]:
+        if not self.playlist:
+            return None
+        return self.playlist.to_m3u8()
 
     @property
     def url(self) -> str:
@@ -81,6 +121,22 @@ class HLS:
     def filename_m3u_norm(self) -> Path:
         return self.filename.with_suffix('.normalized.m3u8')
 
+    @property
+    def filename_sidecar(self) -> Path:
+        return self.filename.with_suffix('.stream.npz')
+
+    @property
+    def filename_report(self) -> Path:
+        return self.filename.with_suffix('.report.json')
+
+    @property
+    def filename_manifest(self) -> Path:
+        return self.filename.with_suffix('.manifest.jsonl')
+
+    @property
+    def filename_part(self) -> Path:
+        return self.filename.with_suffix('.part.ts')
+
     @property
     def best_stream(self) -> Optional[str]:
         m3us = {}
@@ -108,28 +164,38 @@ class HLS:
         return self.info.get('_chat_replay', [])
 
     async def load_m3u(self, refresh=False):
-        if self.m3u and not refresh:
+        if self.playlist and not refresh:
             return
         log.info(f'Downloading playlist for {self.url}')
         url = self.best_stream
         if not url:
             return
-        async with get_session().get(url) as res:
-            self.m3u = m3u8.loads(await res.text(), uri=url)
-
-    def m3u_normalized(self) -> Optional[m3u8.M3U8]:
-        if not self.m3u:
+        self.playlist = Playlist.loads(await request(url, read_text, label='playlist'), uri=url)
+
+    async def poll_m3u(self) -> bool:
+        url = self.playlist.uri or self.best_stream
+        headers = {}
+        if 'ETag' in self.m3u_validators:
+            headers['If-None-Match'] = self.m3u_validators['ETag']
+        if 'Last-Modified' in self.m3u_validators:
+            headers['If-Modified-Since'] = self.m3u_validators['Last-Modified']
+
+        async def read(res):
+            if res.status == 304:
+                return None
+            self.m3u_validators = {k: res.headers[k] for k in ('ETag', 'Last-Modified') if k in res.headers}
+            return await read_text(res)
+
+        content = await request(url, read, label='playlist', headers=headers)
+        if content is None:
+            return False
+        self.playlist = Playlist.loads(content, uri=url)
+        return True
+
+    def m3u_normalized(self) -> Optional[Playlist]:
+        if not self.playlist:
             return
-        normalized = m3u8.M3U8()
-        normalized.data.update({k: self.m3u.data[k] for k in M3U_ATTRS})
-        normalized._initialize_attributes()
-        for seg in self.m3u.segments:
-            seg: m3u8.Segment
-            kwargs = {'uri': seg.absolute_uri,
-                      'discontinuity': seg.discontinuity,
-                      'duration': seg.duration}
-            normalized.add_segment(m3u8.Segment(**kwargs))
-        return normalized
+        return self.playlist.normalized()
 
     async def load_thumbnail(self, out='.'):
         log.info(f'Downloading thumbnail for {self.url}')
@@ -138,44 +204,182 @@ class HLS:
             return
         await download(url, Path(out) / self.filename_thumbnail)
 
-    async def load_stream(self, out='.', stream=None):
+    async def load_stream(self, out='.', stream=None, resume=False, follow=False, workers=1,
+                          start: Optional[float] = None, end: Optional[float] = None,
+                          fragmented=False, overwrite: Optional[bool] = None, **kwargs):
         log.info(f'Downloading {self.filename}')
         playlist = stream or self.m3u_normalized()
         if not playlist:
             return
         path = Path(out) / self.filename
         if path.exists():
-            overwrite = input(f'{path} already exists. Overwrite? ')
-            if not overwrite or overwrite.lower()[0] != 'y':
-                return
-        await self.pipe_stream(playlist, path, '-c', 'copy', '-bsf:a', 'aac_adtstoasc', '-f', 'mp4')
+            # None asks on the terminal; batch jobs pass False and fail instead.
+            if overwrite is None:
+                answer = input(f'{path} already exists. Overwrite? ')
+                if not answer or answer.lower()[0] != 'y':
+                    return
+            elif not overwrite:
+                raise FileExistsError(f'{path} already exists')
+        movflags = ('-movflags', FRAGMENTED_MOVFLAGS) if fragmented else ()
+        ffargs = ('-c', 'copy', '-bsf:a', 'aac_adtstoasc', *movflags, '-f', 'mp4')
+        if follow:
+            await self.follow_stream(Path(out), *ffargs, fragmented=fragmented, **kwargs)
+            log.info(f'Finished downloading {self.filename}')
+            return
+        trim = []
+        if start is not None or end is not None:
+            playlist, offset = playlist.select(start, end)
+            log.info(f'Selected {len(playlist)} segments for {start or 0}s-{end or "end"}')
+            trim = ['-ss', str(offset)]
+            if end is not None:
+                trim += ['-t', str(end - (start or 0))]
+        if resume:
+            await self.resume_stream(playlist, Path(out), *trim, *ffargs, **kwargs)
+        elif workers > 1:
+            await self.split_stream(playlist, Path(out), workers, *trim, fragmented=fragmented, **kwargs)
+        else:
+            ffargs = (*trim, *ffargs)
+            await self.pipe_stream(playlist, path, *ffargs, **kwargs)
         log.info(f'Finished downloading {self.filename}')
 
+    async def split_stream(self, stream: Playlist, out: Path, workers: int, *ffargs,
+                           fragmented=False, **kwargs):
+        parts = stream.partition(workers)
+        log.info(f'Remuxing {len(parts)} parts concurrently')
+        with tempfile.TemporaryDirectory(dir=out) as tempdir:
+            paths = [Path(tempdir) / f'{i:04d}.mts' for i in range(len(parts))]
+            await asyncio.gather(*[self.pipe_stream(part, path, '-c', 'copy', '-f', 'mpegts', **kwargs)
+                                   for part, path in zip(parts, paths)])
+            await concat_mts(paths, out / self.filename, *ffargs, fragmented=fragmented)
+
+    async def resume_stream(self, stream: Playlist, out: Path, *ffargs, native=True, **kwargs):
+        part = out / self.filename_part
+        checkpoint = Checkpoint(out / self.filename_manifest)
+        await save_segments(stream.uris, part, checkpoint, **kwargs)
+        await run_ffmpeg(['-y', '-i', str(part), *ffargs, str(out / self.filename)], capture=None)
+        checkpoint.remove()
+        part.unlink()
+
+    async def iter_live(self, sequence: int) -> AsyncIterator[List[str]]:
+        playlist = self.playlist.normalized()
+        while True:
+            first = sequence - playlist.media_sequence
+            if first < 0:
+                log.warning(f'{-first} segments expired before they could be downloaded')
+                first = 0
+            if first < len(playlist):
+                log.info(f'Downloading {len(playlist) - first} new segments')
+                yield playlist.uris[first:]
+            sequence = playlist.media_sequence + len(playlist)
+            if playlist.is_endlist:
+                break
+            await asyncio.sleep(playlist.targetduration or 10)
+            if await self.poll_m3u():
+                playlist = self.playlist.normalized()
+
+    async def follow_stream(self, out: Path, *ffargs, native=True, fragmented=False, **kwargs):
+        if fragmented:
+            # Remux segments into the output as they arrive instead of
+            # collecting them in a part file first; this can't be resumed.
+            async with FragmentedWriter(out / self.filename, *ffargs) as writer:
+                async for uris in self.iter_live(self.playlist.media_sequence):
+                    async for _, data in SegmentFetcher(uris, **kwargs):
+                        await writer.write(data)
+            return
+        part = out / self.filename_part
+        checkpoint = Checkpoint(out / self.filename_manifest)
+        playlist = self.playlist.normalized()
+        sequence = playlist.media_sequence + checkpoint.resume(playlist.uris, part)
+        with open(part, 'ab') as f:
+            try:
+                async for uris in self.iter_live(sequence):
+                    await append_segments(uris, f, checkpoint, **kwargs)
+            finally:
+                checkpoint.close()
+        await run_ffmpeg(['-y', '-i', str(part), *ffargs, str(out / self.filename)], capture=None)
+        checkpoint.remove()
+        part.unlink()
+
+    def serialize(self, sidecar: Optional[Path] = None) -> JSONDict:
+        info = {**self.info}
+        m3u_dict = {**info.get('_m3u', {})}
+        if sidecar:
+            m3u_dict.pop('content', None)
+            info['_sidecar'] = str(sidecar)
+        elif self.playlist:
+            m3u_dict['content'] = self.playlist.dumps()
+        if self.playlist:
+            m3u_dict['uri'] = self.best_stream
+        if m3u_dict:
+            info['_m3u'] = m3u_dict
+        return info
+
+    def sidecar_arrays(self) -> Dict[str, np.ndarray]:
+        arrays = {}
+        if self.playlist:
+            arrays.update(self.playlist.to_arrays())
+        return arrays
+
+    def open_sidecar(self):
+        return np.load(self.root / self.info['_sidecar'])
+
+    def read_sidecar(self, key: str) -> Optional[np.ndarray]:
+        if not self.info.get('_sidecar'):
+            return None
+        with self.open_sidecar() as arrays:
+            return arrays[key] if key in arrays.files else None
+
+    def read_sidecar_arrays(self) -> Dict[str, np.ndarray]:
+        if not self.info.get('_sidecar'):
+            return {}
+        try:
+            with self.open_sidecar() as arrays:
+                return {key: arrays[key] for key in arrays.files}
+        except OSError as e:
+            log.warning(f'Cannot read {self.info["_sidecar"]}: {e}')
+            return {}
+
     def dump(self, output: Path):
         info_path = output / self.filename_info
+        # Keep what earlier runs stored (e.g. chat) unless this run replaced it.
+        arrays = {**self.read_sidecar_arrays(), **self.sidecar_arrays()}
+        sidecar = None
+        if arrays:
+            sidecar = self.filename_sidecar
+            log.info(f'Dumping stream data to {output / sidecar}')
+            with open(output / sidecar, 'wb+') as f:
+                np.savez_compressed(f, **arrays)
         log.info(f'Dumping info to {info_path}')
-        info = {**self.info}
-        if self.m3u:
-            m3u_dict = info.setdefault('_m3u', {})
-            m3u_dict['uri'] = self.best_stream
-            m3u_dict['content'] = self.m3u.dumps()
         with open(info_path, 'w+') as f:
-            json.dump(info, f)
+            json.dump(self.serialize(sidecar), f)
 
     @staticmethod
-    def get_info(url: str) -> JSONDict:
+    async def get_info(url: str) -> JSONDict:
         log.info(f'Extracting info from {url}')
-        return ytdl.extract_info(url, download=False)
+        loop = asyncio.get_running_loop()
+        # YoutubeDL isn't thread-safe; give each executor call its own
+        # instance so that concurrent metadata jobs don't share one.
+        extractor = youtube_dl.YoutubeDL(ytdl.params)
+        return await loop.run_in_executor(None, partial(extractor.extract_info, url, download=False))
 
     @staticmethod
-    async def pipe_stream(stream: m3u8.M3U8, output: Path, *ffargs):
-        proc = await run_async('ffmpeg', *['-y', '-protocol_whitelist', 'file,http,https,tcp,tls,pipe',
+    async def pipe_stream(stream: Playlist, output: Path, *ffargs, native=False, **kwargs):
+        if not native and is_throttled('video'):
+            # ffmpeg fetches the segments itself, out of reach of the rate limits.
+            log.debug('Rate limits are set; fetching segments natively')
+            native = True
+        if native:
+            return await pipe_segments(stream.uris, output, *ffargs, **kwargs)
+        proc = await run_async('ffmpeg', *['-y', '-progress', 'pipe:1',
+                                           '-protocol_whitelist', 'file,http,https,tcp,tls,pipe',
                                            '-i', 'pipe:', *ffargs, str(output)],
-                               stdin=subprocess.PIPE)
+                               stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        progress = asyncio.ensure_future(track_ffmpeg(Path(output).name, proc.stdout))
         proc.stdin.write(stream.dumps().encode())
         proc.stdin.close()
         await proc.stdin.drain()
         await proc.wait()
+        await progress
 
 
 class TwitchStream(HLS):
@@ -185,17 +389,22 @@ class TwitchStream(HLS):
             'url': self.url,
             'comments': [],
         }
+        self._extended: Optional[Playlist] = None
+        self._extended_loaded = False
 
     @property
     def filename_chat(self) -> Path:
         return self.filename.with_suffix('.chat.json')
 
+    @property
+    def filename_chat_log(self) -> Path:
+        return self.filename.with_suffix('.chat.jsonl')
+
     @property
     def is_trimmed(self):
-        if self.m3u is None:
+        if self.playlist is None:
             return None
-        return (RE_TRIMMED_SEG.search(self.m3u.segments[0].uri) is not None
-                or RE_TRIMMED_SEG.search(self.m3u.segments[1].uri) is not None)
+        return bool(self.playlist.has_flag(FLAG_TRIMMED)[:2].any())
 
     @property
     def chat_url(self) -> Optional[str]:
@@ -204,87 +413,186 @@ class TwitchStream(HLS):
             return None
         return chat[0]['url']
 
-    def m3u_normalized(self, extended=True) -> m3u8.M3U8:
-        normalized = super().m3u_normalized()
-        if not extended:
-            return normalized
-        for seg in normalized.segments:
-            seg: m3u8.Segment
-            trimmed = RE_TRIMMED_SEG.search(seg.uri)
-            if trimmed:
-                name = f'{trimmed.group(1)}.ts'
-                seg.uri = url_path_op(seg.absolute_uri, Path.with_name, name)
-                seg.duration = normalized.data['targetduration']
-        return normalized
+    @property
+    def extended(self) -> Optional[Playlist]:
+        if self._extended is None and not self._extended_loaded and self.playlist:
+            # Restore a previous run's validation from the sidecar.
+            self._extended_loaded = True
+            arrays = self.read_sidecar_arrays()
+            sizes = arrays.get('extended_sizes')
+            flags = arrays.get('extended_flags')
+            if sizes is not None and flags is not None and len(sizes) == len(self.playlist):
+                extended = self.playlist.normalized(True)
+                original = self.playlist.normalized(False)
+                for i in np.flatnonzero(flags & FLAG_TRIMMED).tolist():
+                    extended.names[i] = original.names[i]
+                    extended.durations[i] = original.durations[i]
+                extended.flags = flags.copy()
+                extended.sizes = sizes.copy()
+                self._extended = extended
+        return self._extended
+
+    @extended.setter
+    def extended(self, value: Optional[Playlist]):
+        self._extended = value
+
+    def m3u_normalized(self, extended=True) -> Optional[Playlist]:
+        if not self.playlist:
+            return
+        if extended and self.extended:
+            return self.extended
+        return self.playlist.normalized(extended)
 
     def scan_for_muted(self):
-        if not self.m3u:
+        if not self.playlist:
             return
-        muted = []
-        time = 0
-        start = None
-        end = None
-        segment_before = None
-        segment_after = None
-
-        def add():
-            muted.append({
-                'start': start,
-                'end': end,
-                'before': segment_before,
-                'after': segment_after,
-            })
-        for seg in self.m3u.segments:
-            if end is not None:
-                segment_after = seg.uri
-                add()
-                start = end = segment_before = segment_after = None
-            if start is None:
-                if 'muted' in seg.uri:
-                    start = time
-                else:
-                    segment_before = seg.uri
-            if start is not None and 'muted' not in seg.uri:
-                end = time
-            time += seg.duration
-        if start is not None:
-            end = time
-            add()
         m3u_dict = self.info.setdefault('_m3u', {})
-        m3u_dict['muted'] = muted
+        m3u_dict['muted'] = self.playlist.muted_ranges()
 
-    async def load_stream(self, extended=False, out='.'):
-        playlist = self.m3u_normalized(extended)
-        await super().load_stream(out, playlist)
+    async def validate_extended(self) -> Optional[Playlist]:
+        if not self.playlist:
+            return
+        if self.extended:
+            return self.extended
+        original = self.playlist.normalized(False)
+        extended = self.playlist.normalized(True)
+        rewritten = np.flatnonzero(self.playlist.has_flag(FLAG_TRIMMED))
+        if not rewritten.size:
+            return extended
+
+        async def head(res: aiohttp.ClientResponse) -> Optional[int]:
+            if res.status in (403, 404):
+                return None
+            res.raise_for_status()
+            return -1 if res.content_length is None else res.content_length
+
+        log.info(f'Validating {rewritten.size} extended segments')
+        sizes = await asyncio.gather(*[request(extended.names[i], head, method='HEAD', label='head')
+                                       for i in rewritten])
+        missing = 0
+        for i, size in zip(rewritten.tolist(), sizes):
+            if size is None:
+                # Fall back to the trimmed segment the playlist actually lists.
+                extended.names[i] = original.names[i]
+                extended.durations[i] = original.durations[i]
+                extended.flags[i] |= FLAG_TRIMMED
+                missing += 1
+            else:
+                extended.sizes[i] = size
+        if missing:
+            log.warning(f'{missing} of {rewritten.size} extended segments are missing; '
+                        'using the trimmed segments instead')
+        self.extended = extended
+        return extended
+
+    async def load_stream(self, extended=False, out='.', **kwargs):
+        # Following reads the live playlist, so there is nothing to validate.
+        if extended and not kwargs.get('follow'):
+            with phase('validate'):
+                playlist = await self.validate_extended()
+        else:
+            playlist = self.m3u_normalized(False)
+        await super().load_stream(out, playlist, **kwargs)
 
-    async def load_chat(self):
-        log.info(f'Downloading chat replay for {self.url}')
-        comments = []
-        params = {}
-        headers = {
+    @property
+    def chat_headers(self) -> Dict[str, str]:
+        return {
             'Accept': 'application/vnd.twitchtv.v5+json; charset=UTF-8',
             'Accept-Encoding': 'gzip, deflate, br',
             'Content-Type': 'application/json; charset=UTF-8',
             'Origin': 'https://www.twitch.tv',
             'Referer': self.url,
         }
+
+    async def load_chat(self, parallel=1, out: Optional[Path] = None):
+        log.info(f'Downloading chat replay for {self.url}')
         url = self.chat_url
         if not url:
             return
+        duration = self.info.get('duration')
+        if parallel <= 1 or not duration:
+            ranges = [(None, None)]
+        else:
+            step = duration / parallel
+            bounds = [int(step * i) for i in range(parallel)]
+            ranges = [*zip(bounds, [*bounds[1:], None])]
+
+        if out is not None:
+            with ChatWriter(Path(out) / self.filename_chat_log, len(ranges)) as writer:
+                async def write_range(part, start, end):
+                    async for page in self.iter_chat(url, start, end):
+                        writer.write(page, part)
+
+                await asyncio.gather(*[write_range(i, *r) for i, r in enumerate(ranges)])
+            log.info(f'Saved {writer.count} comments to {writer.path}')
+            return
+
+        async def load_range(start, end):
+            comments = []
+            async for page in self.iter_chat(url, start, end):
+                comments.extend(page)
+            return comments
+
+        pages = await asyncio.gather(*[load_range(start, end) for start, end in ranges])
+        self.chat['comments'] = self.merge_chat(*pages)
+
+    def export_chat(self, out: Path, remove=False):
+        source = Path(out) / self.filename_chat_log
+        if source.exists():
+            export_chat(source, Path(out) / self.filename_chat, self.url)
+            if remove:
+                source.unlink()
+            return
+        chat = self.read_sidecar('chat')
+        if chat is not None:
+            comments = (json.loads(line) for line in chat.tobytes().decode('utf8').splitlines())
+            export_comments(comments, Path(out) / self.filename_chat, self.url)
+
+    async def iter_chat(self, url: str, start: Optional[int] = None,
+                        end: Optional[int] = None) -> AsyncIterator[List[JSONDict]]:
+        params = {}
+        if start:
+            params['content_offset_seconds'] = start
+        headers = self.chat_headers
         while True:
-            log.debug(f'Downloading {url}')
-            async with get_semaphore(), get_session().get(url, params=params, headers=headers) as res:
-                data = await res.json()
-                comments.extend(data['comments'])
-                cursor = data.get('_next')
-                if cursor:
-                    params['cursor'] = cursor
-                else:
-                    break
-        self.chat['comments'] = comments
+            log.debug(f'Downloading {url} {params}')
+            data = await request(url, partial(read_json, kind='chat'), label='chat', kind='chat',
+                                 params=params, headers=headers)
+            comments = data['comments']
+            cursor = data.get('_next')
+            if start:
+                comments = [c for c in comments if c['content_offset_seconds'] >= start]
+            if end is not None:
+                within = [c for c in comments if c['content_offset_seconds'] < end]
+                if len(within) < len(comments):
+                    cursor = None
+                comments = within
+            yield comments
+            if not cursor:
+                break
+            params = {'cursor': cursor}
 
-    def dump(self, output: Path):
-        super().dump(output)
+    @staticmethod
+    def merge_chat(*pages: List[JSONDict]) -> List[JSONDict]:
+        seen = set()
+        comments = []
+        for page in pages:
+            for comment in page:
+                if comment['_id'] in seen:
+                    continue
+                seen.add(comment['_id'])
+                comments.append(comment)
+        comments.sort(key=lambda c: (c['content_offset_seconds'], c.get('created_at', '')))
+        return comments
+
+    def sidecar_arrays(self) -> Dict[str, np.ndarray]:
+        arrays = super().sidecar_arrays()
+        if self.extended:
+            # Aligned with the playlist; trimmed segments that fell back
+            # keep FLAG_TRIMMED here.
+            arrays['extended_sizes'] = self.extended.sizes
+            arrays['extended_flags'] = self.extended.flags
         if self.chat['comments']:
-            with open(output / self.filename_chat, 'w+') as f:
-                json.dump(self.chat, f)
+            jsonl = ''.join(json.dumps(c) + '\n' for c in self.chat['comments'])
+            arrays['chat'] = np.frombuffer(jsonl.encode('utf8'), dtype=np.uint8)
+        return arrays
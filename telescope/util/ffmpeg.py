@@ -12,17 +12,33 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import asyncio
 import logging
 import subprocess
 import tempfile
 from asyncio.subprocess import create_subprocess_exec as run_async
+from functools import partial
 from pathlib import Path
-from typing import List
+from typing import AsyncIterator, Dict, List, Optional
 
-from audio_offset_finder import find_offset
+from audio_offset_finder import FeatureCache, find_offset
+
+from .fs import cache_root
 
 log = logging.getLogger('mpegts')
 
+FRAGMENTED_MOVFLAGS = 'frag_keyframe+empty_moov+default_base_moof'
+
+DEFAULT_FEATURE_ROOT = cache_root('features')
+DEFAULT_FEATURE_CACHE_SIZE = 1024 ** 3
+
+feature_cache: Optional[FeatureCache] = None
+
+
+def init_feature_cache(root: Path = DEFAULT_FEATURE_ROOT, max_size: int = DEFAULT_FEATURE_CACHE_SIZE):
+    global feature_cache
+    feature_cache = FeatureCache(str(root), max_size) if max_size > 0 else None
+
 
 class FFmpegException(RuntimeError):
     def __init__(self, stderr: bytes):
@@ -32,31 +48,93 @@ class FFmpegException(RuntimeError):
 
 async def run_ffmpeg(args: List[str], in_=None, *, executable='ffmpeg',
                      capture=subprocess.PIPE) -> bytes:
-    proc = await run_async(executable, *args, stderr=capture, stdout=capture)
+    stdin = subprocess.PIPE if in_ is not None else None
+    proc = await run_async(executable, *args, stdin=stdin, stderr=capture, stdout=capture)
     stdout, stderr = await proc.communicate(in_)
     if proc.returncode != 0:
         raise FFmpegException(stderr)
     return stdout
 
 
-async def get_start_time(file) -> float:
+async def read_progress(reader: asyncio.StreamReader) -> AsyncIterator[Dict[str, str]]:
+    progress = {}
+    async for line in reader:
+        key, _, value = line.decode('utf8', 'replace').strip().partition('=')
+        progress[key] = value
+        if key == 'progress':
+            yield progress
+            progress = {}
+
+
+async def get_start_time(file, data: bytes = None) -> float:
     args = '-v error -show_entries format=start_time -of default=noprint_wrappers=1:nokey=1'.split(' ')
-    return float(await run_ffmpeg([*args, file], executable='ffprobe'))
+    if data is not None:
+        file = 'pipe:'
+    return float(await run_ffmpeg([*args, str(file)], data, executable='ffprobe'))
 
 
 async def trim_overlap(head: Path, segment: Path, output: Path):
-    offset, score = find_offset(str(head), str(segment))
+    loop = asyncio.get_running_loop()
+    offset, score = await loop.run_in_executor(None, partial(find_offset, str(head), str(segment),
+                                                             cache=feature_cache))
     log.info(f'Offset: {offset}s')
     await run_ffmpeg(['-i', str(head), '-to', str(offset), '-c', 'copy', str(output)])
 
 
-async def concat_mts(segments: List[Path], output: Path, genpts=True, faststart=True):
+async def concat_mts(segments: List[Path], output: Path, *ffargs, genpts=True, faststart=True,
+                     fragmented=False):
+    # A fragmented MP4 is written front to back in a single pass, whereas
+    # faststart rewrites the whole file to move the index to the front.
     with tempfile.NamedTemporaryFile() as f:
         for s in segments:
             f.write(f"file '{str(s.resolve(True))}'\n".encode('utf8'))
+        f.flush()
         prefix = ['-fflags', '+genpts'] if genpts else []
-        faststart = ['-movflags', 'faststart'] if faststart else []
-        await run_ffmpeg([*prefix, '-f', 'concat', '-safe', '0',
-                          '-i', str(Path(f.name).resolve()), *faststart,
-                          '-c', 'copy', str(output)],
+        if fragmented:
+            movflags = ['-movflags', FRAGMENTED_MOVFLAGS]
+        elif faststart:
+            movflags = ['-movflags', 'faststart']
+        else:
+            movflags = []
+        await run_ffmpeg(['-y', *prefix, '-f', 'concat', '-safe', '0',
+                          '-i', str(Path(f.name).resolve()), *movflags,
+                          '-c', 'copy', *ffargs, str(output)],
                          capture=None)
+
+
+class FragmentedWriter:
+    # Remuxes MPEG-TS written to ffmpeg's stdin into a fragmented MP4 as
+    # it arrives, so the output grows (and stays playable) while segments
+    # are still being appended.
+
+    def __init__(self, output: Path, *ffargs):
+        self.output = Path(output)
+        self.ffargs = ffargs
+        self.proc: Optional[asyncio.subprocess.Process] = None
+        self.stderr: Optional[asyncio.Future] = None
+
+    async def open(self):
+        self.proc = await run_async('ffmpeg', '-y', '-nostats', '-loglevel', 'error',
+                                    '-f', 'mpegts', '-i', 'pipe:', '-c', 'copy',
+                                    *self.ffargs, '-movflags', FRAGMENTED_MOVFLAGS, '-f', 'mp4',
+                                    str(self.output), stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+        # Drain stderr alongside the writes so that a chatty ffmpeg can't
+        # block on a full pipe.
+        self.stderr = asyncio.ensure_future(self.proc.stderr.read())
+
+    async def write(self, data: bytes):
+        self.proc.stdin.write(data)
+        await self.proc.stdin.drain()
+
+    async def close(self):
+        self.proc.stdin.close()
+        stderr = await self.stderr
+        if await self.proc.wait() != 0:
+            raise FFmpegException(stderr)
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
@@ -0,0 +1,138 @@
+# Copyright 2021 Tony Wu +https://github.com/tonywu7/
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import logging
+import os
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Optional
+
+import simplejson as json
+
+from .ffmpeg import FFmpegException, run_ffmpeg
+from .fs import atomic_write
+from .types import JSONDict
+
+log = logging.getLogger('segments')
+
+INDEX_FILE = '.segments.json'
+PROBE_ARGS = ['-v', 'error', '-of', 'json',
+              '-show_entries', 'format=start_time,duration:stream=index,codec_type,codec_name,start_time']
+
+
+class Segment(NamedTuple):
+    path: Path
+    start: float
+    duration: float
+    streams: List[JSONDict]
+
+    @property
+    def end(self) -> float:
+        return self.start + self.duration
+
+
+class SegmentIndexError(RuntimeError):
+    def __init__(self, paths: List[Path]):
+        super().__init__(f'Cannot probe {len(paths)} segments: ' + ', '.join(p.name for p in paths))
+        self.paths = paths
+
+
+class Discontinuity(NamedTuple):
+    before: Segment
+    after: Segment
+    delta: float
+
+    @property
+    def is_gap(self) -> bool:
+        return self.delta > 0
+
+
+async def probe_segment(path: Path) -> JSONDict:
+    data = json.loads(await run_ffmpeg([*PROBE_ARGS, str(path)], executable='ffprobe'))
+    fmt = data.get('format', {})
+    return {
+        'start': float(fmt['start_time']),
+        'duration': float(fmt.get('duration') or 0),
+        'streams': data.get('streams', []),
+    }
+
+
+def read_index(directory: Path) -> Dict[str, JSONDict]:
+    try:
+        with open(directory / INDEX_FILE) as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return {}
+
+
+def write_index(directory: Path, index: Dict[str, JSONDict]):
+    with atomic_write(directory / INDEX_FILE) as f:
+        json.dump(index, f)
+
+
+async def index_segments(directory: Path, suffix='.mts', jobs: Optional[int] = None) -> List[Segment]:
+    # Entries are reused as long as the file's size and mtime haven't
+    # changed, so only new or modified segments are probed again.
+    directory = Path(directory)
+    cached = read_index(directory)
+    index = {}
+    sem = asyncio.Semaphore(jobs or os.cpu_count() or 1)
+    stale = []
+    failed: List[Path] = []
+
+    for path in directory.iterdir():
+        if path.suffix != suffix:
+            continue
+        stat = path.stat()
+        entry = cached.get(path.name)
+        if entry and entry['mtime'] == stat.st_mtime and entry['size'] == stat.st_size:
+            index[path.name] = entry
+        else:
+            stale.append((path, stat))
+
+    async def probe(path: Path, stat: os.stat_result):
+        async with sem:
+            try:
+                info = await probe_segment(path)
+            except (FFmpegException, KeyError, ValueError) as e:
+                log.error(f'Cannot probe {path}: {e}')
+                failed.append(path)
+                return
+        index[path.name] = {'mtime': stat.st_mtime, 'size': stat.st_size, **info}
+
+    if stale:
+        log.info(f'Probing {len(stale)} segments in {directory}')
+        await asyncio.gather(*[probe(*s) for s in stale])
+    if stale or index.keys() != cached.keys():
+        write_index(directory, index)
+    # Leaving a segment out would silently drop recorded video.
+    if failed:
+        raise SegmentIndexError(sorted(failed))
+
+    segments = [Segment(directory / name, e['start'], e['duration'], e['streams'])
+                for name, e in index.items()]
+    # The recorder names segments after wall-clock time, so names sort
+    # chronologically; PTS can reset on reconnects or wrap around and is
+    # only used to report discontinuities.
+    segments.sort(key=lambda s: s.path.name)
+    return segments
+
+
+def find_discontinuities(segments: List[Segment], tolerance=0.1) -> List[Discontinuity]:
+    found = []
+    for before, after in zip(segments[:-1], segments[1:]):
+        delta = after.start - before.end
+        if abs(delta) > tolerance:
+            found.append(Discontinuity(before, after, delta))
+    return found
@@ -0,0 +1,24 @@
+import numpy as np
+import pytest
+
+from audio_offset_finder import cross_correlation, cross_correlation_naive, std_mfcc
+
+
+@pytest.mark.parametrize('n1, n2, nframes', [(3000, 1200, 1000), (1000, 1000, 1000), (500, 200, 50)])
+def test_cross_correlation_matches_naive(n1, n2, nframes):
+    rng = np.random.default_rng(n1 + n2 + nframes)
+    mfcc1 = std_mfcc(rng.normal(size=(n1, 13)))
+    mfcc2 = std_mfcc(rng.normal(size=(n2, 13)))
+    mfcc2[:nframes // 2] = mfcc1[n1 // 3:n1 // 3 + nframes // 2]
+    expected = cross_correlation_naive(mfcc1, mfcc2, nframes)
+    actual = cross_correlation(mfcc1, mfcc2, nframes)
+    assert actual.shape == expected.shape
+    assert np.allclose(actual, expected)
+    assert np.argmax(actual) == np.argmax(expected)
+
+
+def test_cross_correlation_short_input():
+    rng = np.random.default_rng(0)
+    mfcc1 = rng.normal(size=(10, 13))
+    mfcc2 = rng.normal(size=(100, 13))
+    assert cross_correlation(mfcc1, mfcc2, 50).shape == (0,)
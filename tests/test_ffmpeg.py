@@ -0,0 +1,14 @@
+import asyncio
+import os
+import stat
+
+from telescope.util.ffmpeg import get_start_time
+
+
+def test_get_start_time_from_bytes(tmp_path, monkeypatch):
+    # Stand-in for ffprobe that reports how many bytes it read from stdin
+    ffprobe = tmp_path / 'ffprobe'
+    ffprobe.write_text('#!/bin/sh\n[ "$(eval echo \\${$#})" = pipe: ] || exit 1\nwc -c\n')
+    ffprobe.chmod(ffprobe.stat().st_mode | stat.S_IEXEC)
+    monkeypatch.setenv('PATH', f'{tmp_path}{os.pathsep}{os.environ["PATH"]}')
+    assert asyncio.run(get_start_time('pipe:', b'x' * 42)) == 42.0